@@ -13,20 +13,33 @@
 """
 This script searches Sonar DNS data provided through Rapid7 Open Data.
 This script searches the data for the root domains tracked by Marinus.
-It will store the Sonar files in a './files' directory.
+The files are streamed and decompressed directly from Rapid7.
+They are only stored in the './files' directory when --save_to_disk is specified.
 """
 
 import argparse
+import fcntl
+import gc
+import gzip
+import io
 import ipaddress
 import json
 import logging
+import multiprocessing
 import os
-import subprocess
+import queue
+import resource
+import shutil
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import requests
+from pymongo import ASCENDING, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, OperationFailure
 from libs3 import (
     DNSManager,
     GoogleDNS,
@@ -37,19 +50,194 @@ from libs3 import (
 )
 from libs3.LoggingUtil import LoggingUtil
 from libs3.ZoneManager import ZoneManager
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
+try:
+    # orjson is significantly faster than the standard library for large Sonar files
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
-def is_running(process):
+# For each sonar_file_type: the Rapid7 listing to search, the log message,
+# and the MyHTMLParser URL attributes to process with their record types
+SONAR_FILE_TYPES = {
+    "dns-any": ("fdns", "Updating DNS ANY records", [("any_url", "ANY")]),
+    "dns-a": (
+        "fdns",
+        "Updating DNS A, AAAA, and CNAME records",
+        [("a_url", "A"), ("aaaa_url", "AAAA"), ("cname_url", "CNAME")],
+    ),
+    "rdns": ("rdns", "Updating RDNS records", [("rdns_url", "RDNS")]),
+}
+
+# Sonar batches can be replayed from the next Sonar file, so the bulk writes
+# only wait for the primary to acknowledge them rather than the journal.
+# Writes stay acknowledged so that BulkWriteErrors are still reported.
+SONAR_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+# The number of matching records to send to the database in each bulk_write
+BATCH_SIZE = 1000
+
+# The number of unique IP addresses to buffer before writing RDNS records
+RDNS_BATCH_SIZE = 50000
+
+# The number of decompressed bytes read at a time when parsing RDNS files
+READ_SIZE = 1024 * 1024
+
+# The approximate number of decompressed bytes handed to each parsing worker
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# The maximum number of chunks or batches waiting between pipeline stages
+QUEUE_SIZE = 64
+
+# How many batches to write between garbage collections
+GC_INTERVAL = 10
+
+# How often to log the number of lines processed
+PROGRESS_INTERVAL = 100000
+
+# Set by init_worker within each parsing process
+worker_zone_set = None
+worker_logger = None
+
+
+class QueueReader(io.RawIOBase):
+    """
+    A read-only file object over the chunks that a DownloadThread places on a queue.
+    This allows gzip.GzipFile to decompress the data while it is still downloading.
+    """
+
+    def __init__(self, chunk_queue):
+        io.RawIOBase.__init__(self)
+        self.chunk_queue = chunk_queue
+        self.buffer = memoryview(b"")
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) == 0 and not self.eof:
+            chunk = self.chunk_queue.get()
+            if chunk is None:
+                self.eof = True
+            elif isinstance(chunk, Exception):
+                raise chunk
+            else:
+                self.buffer = memoryview(chunk)
+
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+class DownloadThread(threading.Thread):
+    """
+    Download the compressed Sonar file into a bounded queue of chunks.
+    A None marks the end of the file and an exception is passed on to the reader.
     """
-    Is the provided process name is currently running?
+
+    def __init__(self, req, chunk_queue):
+        threading.Thread.__init__(self, daemon=True)
+        self.req = req
+        self.chunk_queue = chunk_queue
+
+    def run(self):
+        try:
+            for chunk in self.req.iter_content(chunk_size=READ_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    self.chunk_queue.put(chunk)
+            self.chunk_queue.put(None)
+        except Exception as ex:
+            self.chunk_queue.put(ex)
+
+
+class WriterThread(threading.Thread):
+    """
+    Write batches to the database while the main thread continues parsing.
+    The first error is raised to the main thread by the next submit or by finish.
+    """
+
+    def __init__(self, write_batch):
+        threading.Thread.__init__(self, daemon=True)
+        self.write_batch = write_batch
+        self.batch_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.error = None
+
+    def submit(self, *args):
+        if self.error is not None:
+            raise self.error
+        self.batch_queue.put(args)
+
+    def finish(self):
+        self.batch_queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        batch_count = 0
+        while True:
+            args = self.batch_queue.get()
+            if args is None:
+                return
+            if self.error is not None:
+                # Keep draining the queue so that submit never blocks
+                continue
+            try:
+                self.write_batch(*args)
+            except (Exception, SystemExit) as ex:
+                # The perform_* helpers exit once their retries are exhausted
+                self.error = ex
+            del args
+
+            # Periodically reclaim the short-lived records from the written batches
+            batch_count += 1
+            if batch_count % GC_INTERVAL == 0:
+                gc.collect(1)
+
+
+def acquire_lock(lock_file):
+    """
+    Take an exclusive lock on lock_file so that only one instance runs at a time.
+    The lock is released by the OS when the process exits, even after a crash.
+    Returns None if another instance already holds the lock.
     """
-    proc_list = subprocess.Popen(["pgrep", "-f", process], stdout=subprocess.PIPE)
-    for proc in proc_list.stdout:
-        if proc.decode("utf-8").rstrip() != str(os.getpid()) and proc.decode(
-            "utf-8"
-        ).rstrip() != str(os.getppid()):
-            return True
-    return False
+    lock_f = open(lock_file, "a")
+    try:
+        fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_f.close()
+        return None
+
+    lock_f.truncate(0)
+    lock_f.write(str(os.getpid()))
+    lock_f.flush()
+    return lock_f
+
+
+def requests_retry_session(
+    retries=5,
+    backoff_factor=1,
+    status_forcelist=[502, 503, 504],
+    session=None,
+):
+    """
+    Create a session that retries transient failures during the long Sonar downloads.
+    """
+    session = session or requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
 
 
 def download_file(s, url, data_dir):
@@ -59,82 +247,204 @@ def download_file(s, url, data_dir):
     local_filename = data_dir + url.split("/")[-1]
     # NOTE the stream=True parameter
     req = s.get(url, stream=True)
+    req.raise_for_status()
+    # Save the gzip file exactly as it was sent
+    req.raw.decode_content = False
     with open(local_filename, "wb") as out_f:
-        for chunk in req.iter_content(chunk_size=128 * 1024):
-            if chunk:  # filter out keep-alive new chunks
-                out_f.write(chunk)
+        shutil.copyfileobj(req.raw, out_f, length=1024 * 1024)
     return local_filename
 
 
-def find_zone(domain, zones):
+def find_zone(domain, zone_set):
     """
     Determine if the domain is in a tracked zone.
+    The labels are walked from left to right so that each parent domain
+    is checked against the set of zones with a single lookup.
+    Each parent domain is a slice of the original name rather than a join.
     """
     if domain is None:
         return ""
 
-    for zone in zones:
-        if domain.endswith("." + zone) or domain == zone:
-            return zone
-    return ""
+    candidate = domain
+    while True:
+        if candidate in zone_set:
+            return candidate
+        dot = candidate.find(".")
+        if dot == -1:
+            return ""
+        candidate = candidate[dot + 1 :]
 
 
-def update_dns(logger, dns_file, zones, dns_mgr):
+def init_worker(zone_set, log_name, log_level):
     """
-    Insert any matching Sonar DNS records in the Marinus database.
+    Store the zone set in each worker process so that it is only sent once.
+    The forkserver workers do not inherit the parent's logging configuration,
+    so it is recreated here with the parent's logger name and level.
     """
-    with open(dns_file, "r") as dns_f:
-        for line in dns_f:
-            try:
-                data = json.loads(line)
-            except ValueError:
-                continue
-            except Exception as e:
-                logger.error("Error parsing file...")
-                logger.error("Exception: " + str(e))
-                raise
+    global worker_zone_set, worker_logger
+    worker_zone_set = zone_set
+    worker_logger = LoggingUtil.create_log(log_name, log_level)
 
-            dtype = data["type"]
-            try:
-                value = data["value"]
-                domain = data["name"]
-                zone = find_zone(domain, zones)
-            except KeyError:
-                logger.warning("Error with line: " + line)
-                value = ""
-                zone = ""
-                domain = ""
 
-            timestamp = data["timestamp"]
+def read_chunks(file_obj, chunk_size):
+    """
+    Yield blocks of roughly chunk_size bytes that always end on a line boundary.
+    A partial line at the end of a read is carried over to the next block.
+    """
+    tail = b""
+    while True:
+        buf = file_obj.read(chunk_size)
+        if not buf:
+            if tail:
+                yield tail
+            return
+
+        head, sep, tail = (tail + buf).rpartition(b"\n")
+        if sep:
+            yield head
+
+
+def process_dns_chunk(blob):
+    """
+    Parse a block of Sonar DNS lines within a worker process.
+    Returns the number of lines and the records that match a tracked zone.
+    """
+    logger = worker_logger
+
+    # This is the hottest loop in the script, so the globals and the
+    # logging level check are bound to locals once per block
+    loads = json_loads
+    zone_set = worker_zone_set
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+    lines = blob.splitlines()
+    results = []
+    for line in lines:
+        try:
+            data = loads(line)
+        except ValueError:
+            continue
+        except Exception as e:
+            logger.error("Error parsing file...")
+            logger.error("Exception: " + str(e))
+            raise
+
+        dtype = data["type"]
+        try:
+            value = data["value"]
+            domain = data["name"]
+            zone = find_zone(domain, zone_set)
+        except KeyError:
+            logger.warning("Error with line: " + line.decode("utf-8", "replace"))
+            value = ""
+            zone = ""
+            domain = ""
+
+        timestamp = data["timestamp"]
+
+        if zone != "" and value != "":
+            if debug_enabled:
+                logger.debug("Domain matches! %s Zone: %s", domain, zone)
+
+            if dtype.startswith("unk_in_"):
+                # Sonar didn't recognize the response
+                type_num = int(dtype[7:])
+                for type_name, type_value in GoogleDNS.GoogleDNS.DNS_TYPES.items():
+                    if type_value == type_num:
+                        dtype = type_name
+                        break
+
+            if dtype.startswith("unk_in_"):
+                # Marinus didn't recognize it either.
+                logger.warning("Unknown type: " + dtype)
+
+            results.append(
+                {
+                    "fqdn": domain,
+                    "zone": zone,
+                    "type": dtype,
+                    "status": "unknown",
+                    "value": value,
+                    "sonar_timestamp": int(timestamp),
+                }
+            )
+
+    return len(lines), results
+
+
+def bounded_map(executor, fn, iterable, max_pending):
+    """
+    Like executor.map but only reads max_pending items ahead of the results.
+    Executor.map consumes the whole iterable up front, which would
+    decompress the entire Sonar file into memory.
+    """
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(fn, item))
+        if len(futures) >= max_pending:
+            yield futures.popleft().result()
+
+    while len(futures) > 0:
+        yield futures.popleft().result()
+
+
+def update_dns(logger, dns_f, zone_set, dns_mgr):
+    """
+    Insert any matching Sonar DNS records in the Marinus database.
+    The records are read from the provided decompressed file object.
+    The file is parsed in blocks by a pool of worker processes and the
+    matching records are sent to the database in batches.
+    """
+    num_workers = os.cpu_count() or 1
+
+    writer = WriterThread(
+        lambda batch: dns_mgr.insert_records(
+            batch, "sonar_dns", write_concern=SONAR_WRITE_CONCERN
+        )
+    )
+    writer.start()
+
+    line_count = 0
+    match_count = 0
+    pending = []
+    # A single timestamp is shared by every record in a batch
+    batch_now = datetime.now()
+    # The download and writer threads are already running so the workers
+    # are started from a clean forkserver process rather than forked from this one
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=init_worker,
+        initargs=(zone_set, logger.name, logger.getEffectiveLevel()),
+    ) as executor:
+        for num_lines, results in bounded_map(
+            executor, process_dns_chunk, read_chunks(dns_f, CHUNK_SIZE), num_workers * 2
+        ):
+            previous_count = line_count
+            line_count += num_lines
+            match_count += len(results)
+            if line_count // PROGRESS_INTERVAL > previous_count // PROGRESS_INTERVAL:
+                logger.info(
+                    "Processed %d lines with %d matches", line_count, match_count
+                )
 
-            if zone != "" and value != "":
-                logger.debug("Domain matches! " + domain + " Zone: " + zone)
+            for insert_json in results:
+                insert_json["created"] = batch_now
+                pending.append(insert_json)
 
-                if dtype.startswith("unk_in_"):
-                    # Sonar didn't recognize the response
-                    type_num = int(dtype[7:])
-                    g_dns = GoogleDNS.GoogleDNS()
-                    for key, value in g_dns.DNS_TYPES.items():
-                        if value == type_num:
-                            dtype = key
-                            break
+                if len(pending) >= BATCH_SIZE:
+                    writer.submit(pending)
+                    pending = []
+                    batch_now = datetime.now()
 
-                if dtype.startswith("unk_in_"):
-                    # Marinus didn't recognize it either.
-                    logger.warning("Unknown type: " + dtype)
+    if len(pending) > 0:
+        writer.submit(pending)
+    writer.finish()
 
-                insert_json = {}
-                insert_json["fqdn"] = domain
-                insert_json["zone"] = zone
-                insert_json["type"] = dtype
-                insert_json["status"] = "unknown"
-                insert_json["value"] = value
-                insert_json["sonar_timestamp"] = int(timestamp)
-                insert_json["created"] = datetime.now()
-                dns_mgr.insert_record(insert_json, "sonar_dns")
+    logger.info("Processed %d lines with %d matches", line_count, match_count)
 
 
-def check_for_ptr_record(ipaddr, g_dns, zones, dns_manager):
+def check_for_ptr_record(ipaddr, g_dns, zone_set, dns_manager):
     """
     For an identified Sonar RDNS record, confirm that there
     is a related PTR record for the IP address. If confirmed,
@@ -146,7 +456,7 @@ def check_for_ptr_record(ipaddr, g_dns, zones, dns_manager):
         # Lookup failed
         return
 
-    rdns_zone = find_zone(dns_result[0]["value"], zones)
+    rdns_zone = find_zone(dns_result[0]["value"], zone_set)
 
     if rdns_zone != "":
         new_record = dns_result[0]
@@ -156,17 +466,83 @@ def check_for_ptr_record(ipaddr, g_dns, zones, dns_manager):
         dns_manager.insert_record(new_record, "sonar_rdns")
 
 
-def update_rdns(logger, rdns_file, zones, dns_mgr, mongo_connector):
+def flush_rdns(logger, mongo_connector, rdns_collection, pending, batch_now):
+    """
+    Send the buffered Sonar RDNS records to the database in a single bulk_write.
+    The pending dictionary maps each IP to its (fqdn, zone, sonar_timestamp).
+    """
+    if len(pending) == 0:
+        return
+
+    operations = []
+    for ip_addr, (domain, zone, timestamp) in pending.items():
+        operations.append(
+            UpdateOne(
+                {"ip": ip_addr},
+                {
+                    "$set": {
+                        "fqdn": domain,
+                        "zone": zone,
+                        "sonar_timestamp": timestamp,
+                        "updated": batch_now,
+                    },
+                    "$setOnInsert": {
+                        "status": "unknown",
+                        "created": batch_now,
+                    },
+                },
+                upsert=True,
+            )
+        )
+
+    try:
+        mongo_connector.perform_bulk_write(rdns_collection, operations)
+    except BulkWriteError as bwe:
+        logger.error(
+            "Bulk write failed for "
+            + str(len(bwe.details["writeErrors"]))
+            + " of "
+            + str(len(operations))
+            + " RDNS records"
+        )
+
+
+def update_rdns(logger, read_f, zone_set, dns_mgr, mongo_connector):
     """
     Insert any matching Sonar RDNS records in the Marinus database.
+    The records are read from the provided decompressed file object.
+    Matches are collapsed to one upsert per IP address and sent in batches.
     """
-    rdns_collection = mongo_connector.get_sonar_reverse_dns_connection()
+    rdns_collection = mongo_connector.get_sonar_reverse_dns_connection().with_options(
+        write_concern=SONAR_WRITE_CONCERN
+    )
     g_dns = GoogleDNS.GoogleDNS()
 
-    with open(rdns_file, "r") as read_f:
-        for line in read_f:
+    writer = WriterThread(
+        lambda batch, now: flush_rdns(
+            logger, mongo_connector, rdns_collection, batch, now
+        )
+    )
+    writer.start()
+
+    line_count = 0
+    match_count = 0
+    # Sonar often repeats an IP so only the latest record per IP is kept
+    pending = {}
+    # A single timestamp is shared by every record in a batch
+    batch_now = datetime.now()
+    # The logging level is checked once rather than for every match
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    for block in read_chunks(read_f, READ_SIZE):
+        for line in block.splitlines():
+            line_count += 1
+            if line_count % PROGRESS_INTERVAL == 0:
+                logger.info(
+                    "Processed %d lines with %d matches", line_count, match_count
+                )
+
             try:
-                data = json.loads(line)
+                data = json_loads(line)
             except ValueError:
                 continue
             except Exception as e:
@@ -177,7 +553,7 @@ def update_rdns(logger, rdns_file, zones, dns_mgr, mongo_connector):
             try:
                 domain = data["value"]
                 ip_addr = data["name"]
-                zone = find_zone(domain, zones)
+                zone = find_zone(domain, zone_set)
             except KeyError:
                 domain = ""
                 ip_addr = ""
@@ -186,47 +562,101 @@ def update_rdns(logger, rdns_file, zones, dns_mgr, mongo_connector):
             timestamp = data["timestamp"]
 
             if zone != "" and domain != "":
-                logger.debug("Domain matches! " + domain + " Zone: " + zone)
-                result = mongo_connector.perform_count(rdns_collection, {"ip": ip_addr})
-                if result == 0:
-                    insert_json = {}
-                    insert_json["ip"] = ip_addr
-                    insert_json["zone"] = zone
-                    insert_json["fqdn"] = domain
-                    insert_json["status"] = "unknown"
-                    insert_json["sonar_timestamp"] = int(timestamp)
-                    insert_json["created"] = datetime.now()
-                    insert_json["updated"] = datetime.now()
-                    mongo_connector.perform_insert(rdns_collection, insert_json)
-                else:
-                    rdns_collection.update_one(
-                        {"ip": ip_addr},
-                        {"$set": {"fqdn": domain}, "$currentDate": {"updated": True}},
-                    )
+                if debug_enabled:
+                    logger.debug("Domain matches! %s Zone: %s", domain, zone)
+                match_count += 1
+                timestamp = int(timestamp)
+                if ip_addr not in pending:
+                    # The PTR lookup only depends on the IP address
+                    check_for_ptr_record(ip_addr, g_dns, zone_set, dns_mgr)
+                    pending[ip_addr] = (domain, zone, timestamp)
+                elif timestamp >= pending[ip_addr][2]:
+                    pending[ip_addr] = (domain, zone, timestamp)
+
+                if len(pending) >= RDNS_BATCH_SIZE:
+                    writer.submit(pending, batch_now)
+                    pending = {}
+                    batch_now = datetime.now()
+
+    writer.submit(pending, batch_now)
+    writer.finish()
 
-                check_for_ptr_record(ip_addr, g_dns, zones, dns_mgr)
+    logger.info("Processed %d lines with %d matches", line_count, match_count)
 
 
-def download_remote_files(logger, s, file_reference, data_dir, jobs_manager):
+def cleanup(data_dir):
     """
-    Download the provided file URL
+    Remove previously downloaded files from data_dir.
+    The lock file is left in place since it is held by the running script.
     """
-    subprocess.run("rm " + data_dir + "*", shell=True)
+    for entry in os.scandir(data_dir):
+        if entry.is_file() and not entry.name.endswith(".lock"):
+            os.unlink(entry.path)
 
-    dns_file = download_file(s, file_reference, data_dir)
 
-    logger.info("Downloading file")
+def download_remote_files(logger, s, file_reference, data_dir, save_to_disk):
+    """
+    Open the provided file URL as a decompressed stream of bytes.
+    If save_to_disk is set, the file is downloaded to data_dir before it is read.
+    """
+    if save_to_disk:
+        cleanup(data_dir)
 
+        logger.info("Downloading file")
+
+        dns_file = download_file(s, file_reference, data_dir)
+
+        return gzip.open(dns_file, "rb")
+
+    logger.info("Streaming file")
+
+    req = s.get(file_reference, stream=True)
+    req.raise_for_status()
+
+    # The download runs in its own thread so the network and parsing overlap
+    chunk_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    DownloadThread(req, chunk_queue).start()
+
+    return gzip.GzipFile(fileobj=QueueReader(chunk_queue), mode="rb")
+
+
+def create_indexes(logger, sonar_file_type, dns_manager, mongo_connector):
+    """
+    Create the indexes that the batched lookups and upserts depend on.
+    MongoDB does not rebuild an index that already exists.
+    """
     try:
-        subprocess.run(["gunzip", dns_file], check=True)
-    except:
-        logger.error("Could not unzip file: " + dns_file)
-        jobs_manager.record_job_error()
-        exit(1)
+        # DNSManager looks up existing records by fqdn and type. The value is
+        # left out because long TXT values can exceed the index key size.
+        dns_manager.all_dns_collection.create_index(
+            [("fqdn", ASCENDING), ("type", ASCENDING)], background=True
+        )
+    except OperationFailure as err:
+        logger.warning("Could not create index: " + str(err))
+
+    if sonar_file_type == "rdns":
+        try:
+            # RDNS records are upserted by IP. Existing deployments with a
+            # non-unique ip index must first follow the README migration.
+            rdns_collection = mongo_connector.get_sonar_reverse_dns_connection()
+            rdns_collection.create_index(
+                [("ip", ASCENDING)], unique=True, background=True
+            )
+        except OperationFailure as err:
+            # An existing non-unique index or duplicate data will prevent this
+            logger.warning(
+                "Could not create the unique sonar_rdns ip index: "
+                + str(err)
+                + ". See the sonar_rdns migration steps in the README."
+            )
 
-    unzipped_dns = dns_file.replace(".gz", "")
 
-    return unzipped_dns
+def process_url(logger, s, url, data_dir, save_to_disk, handler):
+    """
+    Stream the provided Sonar file URL into the handler for its file type.
+    """
+    with download_remote_files(logger, s, url, data_dir, save_to_disk) as sonar_f:
+        handler(sonar_f)
 
 
 def check_save_location(location):
@@ -245,10 +675,6 @@ def main(logger=None):
     if logger is None:
         logger = LoggingUtil.create_log(__name__)
 
-    if is_running(os.path.basename(__file__)):
-        logger.warning("Already running...")
-        exit(0)
-
     now = datetime.now()
     print("Starting: " + str(now))
     logger.info("Starting...")
@@ -258,7 +684,7 @@ def main(logger=None):
     )
     parser.add_argument(
         "--sonar_file_type",
-        choices=["dns-any", "dns-a", "rdns"],
+        choices=list(SONAR_FILE_TYPES.keys()),
         required=True,
         help='Specify "dns-any", "dns-a", or "rdns"',
     )
@@ -275,8 +701,24 @@ def main(logger=None):
         default="./files/",
         help="The location to save the downloaded files",
     )
+    parser.add_argument(
+        "--save_to_disk",
+        action="store_true",
+        help="Save the downloaded files to the download location before parsing them",
+    )
     args = parser.parse_args()
 
+    save_directory = args.download_location
+    check_save_location(save_directory)
+
+    # The lock file must stay open for as long as the script is running
+    lock_f = acquire_lock(
+        save_directory + os.path.splitext(os.path.basename(__file__))[0] + ".lock"
+    )
+    if lock_f is None:
+        logger.warning("Already running...")
+        exit(0)
+
     if args.database == "remote":
         mongo_connector = RemoteMongoConnector.RemoteMongoConnector()
         dns_manager = DNSManager.DNSManager(mongo_connector, "get_sonar_data_dns")
@@ -285,92 +727,67 @@ def main(logger=None):
         dns_manager = DNSManager.DNSManager(mongo_connector)
 
     zones = ZoneManager.get_distinct_zones(mongo_connector)
+    zone_set = frozenset(zones)
 
-    r7 = Rapid7.Rapid7()
+    create_indexes(logger, args.sonar_file_type, dns_manager, mongo_connector)
 
-    save_directory = args.download_location
-    check_save_location(save_directory)
+    r7 = Rapid7.Rapid7()
 
     # A session is necessary for the multi-step log-in process
-    s = requests.Session()
+    s = requests_retry_session()
 
-    if args.sonar_file_type == "rdns":
-        logger.info("Updating RDNS records")
-        jobs_manager = JobsManager.JobsManager(mongo_connector, "get_sonar_data_rdns")
-        jobs_manager.record_job_start()
+    handlers = {
+        "fdns": lambda sonar_f: update_dns(logger, sonar_f, zone_set, dns_manager),
+        "rdns": lambda sonar_f: update_rdns(
+            logger, sonar_f, zone_set, dns_manager, mongo_connector
+        ),
+    }
 
-        try:
-            html_parser = r7.find_file_locations(s, "rdns", jobs_manager)
-            if html_parser.rdns_url == "":
-                logger.error("Unknown Error")
-                jobs_manager.record_job_error()
-                exit(0)
-
-            unzipped_rdns = download_remote_files(
-                logger, s, html_parser.rdns_url, save_directory, jobs_manager
-            )
-            update_rdns(logger, unzipped_rdns, zones, dns_manager, mongo_connector)
-        except Exception as ex:
-            logger.error("Unexpected error: " + str(ex))
-            jobs_manager.record_job_error()
-            exit(0)
+    # Keep the long-lived setup objects out of the collections during parsing
+    gc.freeze()
 
-        jobs_manager.record_job_complete()
-    elif args.sonar_file_type == "dns-any":
-        logger.info("Updating DNS ANY records")
+    listing, description, file_urls = SONAR_FILE_TYPES[args.sonar_file_type]
+    logger.info(description)
 
-        jobs_manager = JobsManager.JobsManager(
-            mongo_connector, "get_sonar_data_dns-any"
-        )
-        jobs_manager.record_job_start()
+    jobs_manager = JobsManager.JobsManager(
+        mongo_connector, "get_sonar_data_" + args.sonar_file_type
+    )
+    jobs_manager.record_job_start()
 
-        try:
-            html_parser = r7.find_file_locations(s, "fdns", jobs_manager)
-            if html_parser.any_url != "":
-                unzipped_dns = download_remote_files(
-                    logger, s, html_parser.any_url, save_directory, jobs_manager
-                )
-                update_dns(logger, unzipped_dns, zones, dns_manager)
-        except Exception as ex:
-            logger.error("Unexpected error: " + str(ex))
+    try:
+        html_parser = r7.find_file_locations(s, listing, jobs_manager)
+
+        urls = []
+        for url_attribute, record_type in file_urls:
+            url = getattr(html_parser, url_attribute)
+            if url == "":
+                logger.warning("Could not find the " + record_type + " file")
+            else:
+                urls.append((url, record_type))
+
+        if len(urls) == 0:
+            logger.error("Unknown Error")
             jobs_manager.record_job_error()
             exit(0)
 
-        jobs_manager.record_job_complete()
-    elif args.sonar_file_type == "dns-a":
-        logger.info("Updating DNS A, AAAA, and CNAME records")
-
-        jobs_manager = JobsManager.JobsManager(mongo_connector, "get_sonar_data_dns-a")
-        jobs_manager.record_job_start()
+        for url, record_type in urls:
+            logger.info("Updating " + record_type + " records")
+            process_url(
+                logger,
+                s,
+                url,
+                save_directory,
+                args.save_to_disk,
+                handlers[listing],
+            )
+    except Exception as ex:
+        logger.error("Unexpected error: " + str(ex))
+        jobs_manager.record_job_error()
+        exit(0)
 
-        try:
-            html_parser = r7.find_file_locations(s, "fdns", jobs_manager)
-            if html_parser.a_url != "":
-                logger.info("Updating A records")
-                unzipped_dns = download_remote_files(
-                    logger, s, html_parser.a_url, save_directory, jobs_manager
-                )
-                update_dns(logger, unzipped_dns, zones, dns_manager)
-            if html_parser.aaaa_url != "":
-                logger.info("Updating AAAA records")
-                unzipped_dns = download_remote_files(
-                    logger, s, html_parser.aaaa_url, save_directory, jobs_manager
-                )
-                update_dns(logger, unzipped_dns, zones, dns_manager)
-            if html_parser.cname_url != "":
-                logger.info("Updating CNAME records")
-                unzipped_dns = download_remote_files(
-                    logger, s, html_parser.cname_url, save_directory, jobs_manager
-                )
-                update_dns(logger, unzipped_dns, zones, dns_manager)
-        except Exception as ex:
-            logger.error("Unexpected error: " + str(ex))
-            jobs_manager.record_job_error()
-            exit(0)
+    jobs_manager.record_job_complete()
 
-        jobs_manager.record_job_complete()
-    else:
-        logger.error("Unrecognized sonar_file_type option. Exiting...")
+    logger.info("Max RSS: %d KB", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
     now = datetime.now()
     print("Complete: " + str(now))
@@ -18,6 +18,8 @@ import logging
 from datetime import datetime
 
 from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from libs3 import IPManager
 
 
@@ -170,6 +172,99 @@ class DNSManager(object):
             ip_manager = IPManager.IPManager(self.mongo_connector)
             ip_manager.insert_record(result["value"], source_name)
 
+    def insert_records(self, results, source_name, write_concern=None):
+        """
+        Insert a batch of records from the provided source name.
+        This follows the same rules as insert_record but it looks up the existing
+        records with a single query and sends the changes with a single bulk_write.
+        Source metadata is not supported for batches.
+
+        :param results: A list of DNS lookups as JSON objects including
+                        the fqdn, type, value, zone, and created values.
+        :param source_name: The DNS record source ("ssl","virustotal","sonar_dns","common_crawl")
+        :param write_concern: An optional pymongo WriteConcern for the bulk_write.
+                        The collection's default write concern is used when omitted.
+        """
+        # Collapse duplicate records within the batch
+        records = {}
+        for result in results:
+            result["fqdn"] = result["fqdn"].lower()
+            records[(result["fqdn"], result["type"], result["value"])] = result
+
+        if len(records) == 0:
+            return
+
+        query = {
+            "$or": [
+                {"fqdn": key[0], "type": key[1], "value": key[2]}
+                for key in records.keys()
+            ]
+        }
+        existing = {}
+        for check in self.mongo_connector.perform_find(
+            self.all_dns_collection,
+            query,
+            {"fqdn": 1, "type": 1, "value": 1, "sources.source": 1},
+        ):
+            existing[(check["fqdn"], check["type"], check["value"])] = check
+
+        now = datetime.now()
+        operations = []
+        for key, result in records.items():
+            check = existing.get(key)
+            if check is None:
+                result["sources"] = [{"source": source_name, "updated": now}]
+                result["updated"] = now
+                operations.append(InsertOne(result))
+            elif any(source["source"] == source_name for source in check["sources"]):
+                operations.append(
+                    UpdateOne(
+                        {"_id": ObjectId(check["_id"]), "sources.source": source_name},
+                        {
+                            "$set": {
+                                "sources.$.updated": now,
+                                "updated": now,
+                            }
+                        },
+                    )
+                )
+            else:
+                operations.append(
+                    UpdateOne(
+                        {"_id": ObjectId(check["_id"])},
+                        {
+                            "$push": {
+                                "sources": {
+                                    "source": source_name,
+                                    "updated": now,
+                                }
+                            },
+                            "$set": {"updated": now},
+                        },
+                    )
+                )
+
+        collection = self.all_dns_collection
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=write_concern)
+        try:
+            self.mongo_connector.perform_bulk_write(collection, operations)
+        except BulkWriteError as bwe:
+            self._logger.error(
+                "ERROR: Bulk write failed for "
+                + str(len(bwe.details["writeErrors"]))
+                + " of "
+                + str(len(operations))
+                + " records"
+            )
+
+        ip_manager = None
+        for result in records.values():
+            if result["type"] == "a" or result["type"] == "aaaa":
+                if ip_manager is None:
+                    ip_manager = IPManager.IPManager(self.mongo_connector)
+                ip_manager.insert_record(result["value"], source_name)
+
     def find_multiple(self, criteria, source):
         """
         Find multiple records for the specified criteria.
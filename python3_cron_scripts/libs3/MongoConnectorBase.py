@@ -241,3 +241,28 @@ class MongoConnectorBase(object):
                 result = None
 
         return result
+
+    def perform_bulk_write(self, collection, requests, ordered=False):
+        """
+        This will perform a bulk_write with a retry for dropped connections
+        """
+        success = False
+        num_tries = 0
+        while not success:
+            try:
+                result = collection.bulk_write(requests, ordered=ordered)
+                success = True
+            except AutoReconnect:
+                if num_tries < 5:
+                    self._logger.warning(
+                        "Warning: Failed to connect to the database. Retrying."
+                    )
+                    time.sleep(5)
+                    num_tries = num_tries + 1
+                else:
+                    self._logger.error(
+                        "ERROR: Exceeded the max number of connection attempts to MongoDB!"
+                    )
+                    exit(1)
+
+        return result